@@ -2,17 +2,21 @@ import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import httpx
 import os
 import asyncio
 import aiosqlite
 import logging
-from datetime import datetime, timedelta, time
-import pytz
+from datetime import datetime, timedelta, time, timezone
 import re
+import time as systime
 import io
-from collections import defaultdict, deque
-from typing import Optional, List
+import bisect
+from collections import OrderedDict, deque
+from functools import lru_cache
+from itertools import islice
+from typing import Optional, List, Callable, Awaitable
 from dotenv import load_dotenv
 
 # ==============================================================================
@@ -29,7 +33,7 @@ logger = logging.getLogger("AkaneBot")
 
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-JST = pytz.timezone('Asia/Tokyo')
+JST = timezone(timedelta(hours=9), "JST")  # 日本に夏時間はないので固定オフセットで十分
 
 class Config:
     GPT_MODEL = "gpt-5-mini"
@@ -43,6 +47,20 @@ class Config:
     TIMEOUT_MSG = "せっかく話しかけてもらったんやけど、君の質問に答えようと思うとちょっと時間がかかりそうやわ。よかったらもう少し茜が答えやすいようにもっかいやり直してもろてええか？ 頼むわ🙏✨"
     ERROR_MSG = "ごめん、ちょっと調子悪いみたいでうまく答えられへんかったわ... (エラー発生)"
     EMPTY_MSG = "（...言葉が見つからへんみたいや。もう一回試してみて？）"
+    BUSY_MSG = "今ちょっと混んでるみたいや。少し時間をおいてからもう一回話しかけてな🙏"
+
+    AI_CONCURRENCY = 8   # 同時に投げるAI呼び出しの上限
+    AI_MAX_WAITING = 32  # これ以上順番待ちがいたら即「混雑」を返す
+    AI_RPM = 300  # 1分あたりに投げるAI呼び出しの上限 (超えそうなら待ってから投げる)
+    AI_CACHE_MAX = 512  # 翻訳・辞書の結果を覚えておく件数
+    AI_CACHE_TTL = 3600  # 同じ結果を使い回す秒数
+    STREAM_EDIT_INTERVAL = 1.0  # ストリーミング中にメッセージを書き換える間隔 (秒)
+    SPAM_TRACK_MAX = 10000  # 連投チェックで覚えておくユーザー数 (古い順に捨てる)
+    HEART_TRACK_MAX = 10000  # ❤️の数を覚えておくメッセージ数 (古い順に捨てる)
+    XP_CACHE_MAX = 10000  # XPをメモリに置いておくユーザー数 (書き込み済みのものを古い順に捨てる)
+    REMINDER_MAX_SLEEP = 600  # 次のリマインダーが遠くても最長この秒数で見直す
+    DB_READERS = 2  # 読み取り専用コネクション数 (WALなので書き込みと並行して読める)
+    SEND_CONCURRENCY = 5  # 一斉送信 (リマインダー等) で同時に投げるメッセージ数
 
     REGULATION_KEYWORDS = ['表現規制', '規制', '検閲', '制限', '禁止', '表現の自由', '言論統制', '弾圧', 'ポリコレ']
     
@@ -53,8 +71,23 @@ class Config:
         "🇻🇳": "Vietnamese", "🇹🇭": "Thai", "🇮🇩": "Indonesian"
     }
 
+MENTION_RE = re.compile(r'<@!?\d+>')
+REGULATION_RE = re.compile("|".join(map(re.escape, Config.REGULATION_KEYWORDS)))
+
+_today_cache = [0.0, ""]  # [次のJST 0時のUNIX秒, 'YYYY-MM-DD']
+
+def today_jst() -> str:
+    # 日付文字列はJSTの0時を跨いだ時だけ作り直す
+    if systime.time() >= _today_cache[0]:
+        now = datetime.now(JST)
+        _today_cache[1] = now.strftime('%Y-%m-%d')
+        _today_cache[0] = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    return _today_cache[1]
+
 if OPENAI_API_KEY:
-    openai_client = openai.OpenAI(api_key=OPENAI_API_KEY, timeout=60.0)
+    # 同時呼び出し数ぶんの接続を張りっぱなしにして TLS を使い回す
+    openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=60.0, http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=Config.AI_CONCURRENCY, max_keepalive_connections=Config.AI_CONCURRENCY, keepalive_expiry=120)))
 else:
     openai_client = None
     logger.warning("OpenAI API Key is missing.")
@@ -64,86 +97,250 @@ else:
 # ==============================================================================
 
 class DatabaseManager:
+    SETTING_COLS = ("welcome_ch", "log_ch", "starboard_ch", "auto_chat_ch")
+    # SQL は列ごとに固定文字列にしておき、sqlite3 の文のキャッシュに乗せる
+    SET_CONFIG_SQL = {c: f"INSERT INTO guild_settings (guild_id, {c}) VALUES (?, ?) ON CONFLICT(guild_id) DO UPDATE SET {c}=excluded.{c}" for c in SETTING_COLS}
+    GET_CONFIG_SQL = f"SELECT {', '.join(SETTING_COLS)} FROM guild_settings WHERE guild_id=?"
+
     def __init__(self, db_path):
         self.path = db_path
+        self._xp: OrderedDict[int, list[int]] = OrderedDict()
+        self._xp_dirty: set[int] = set()
+        self._xp_flushing: set[int] = set()  # 書き込み中のユーザー (失敗したら dirty に戻るので捨てない)
+        self.conn: Optional[aiosqlite.Connection] = None
+        self._config: dict[int, dict[str, Optional[int]]] = {}
+        self._lock = asyncio.Lock()
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._usage: dict[str, int] = {}
+        self._usage_dirty: set[str] = set()
+        self._usage_pending: list[tuple[str, str, int]] = []  # 日付を跨いだ未書き込み分
+        self._usage_day = ""
 
     async def init(self):
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute('''CREATE TABLE IF NOT EXISTS usage_log (user_id TEXT, date TEXT, count INTEGER DEFAULT 0, UNIQUE(user_id, date))''')
-            await db.execute('''CREATE TABLE IF NOT EXISTS starboard_log (message_id INTEGER PRIMARY KEY)''')
-            await db.execute('''CREATE TABLE IF NOT EXISTS guild_settings (guild_id INTEGER PRIMARY KEY, welcome_ch INTEGER, log_ch INTEGER, starboard_ch INTEGER, auto_chat_ch INTEGER)''')
-            await db.execute('''CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, xp INTEGER DEFAULT 0, level INTEGER DEFAULT 1)''')
-            await db.execute('''CREATE TABLE IF NOT EXISTS level_rewards (guild_id INTEGER, level INTEGER, role_id INTEGER, PRIMARY KEY(guild_id, level))''')
-            await db.execute('''CREATE TABLE IF NOT EXISTS reaction_roles (message_id INTEGER, emoji TEXT, role_id INTEGER)''')
-            await db.execute('''CREATE TABLE IF NOT EXISTS ng_words (guild_id INTEGER, word TEXT)''')
-            await db.execute('''CREATE TABLE IF NOT EXISTS auto_replies (guild_id INTEGER, trigger TEXT, response TEXT)''')
-            await db.execute('''CREATE TABLE IF NOT EXISTS reminders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, channel_id INTEGER, message TEXT, end_time TEXT)''')
-            await db.execute('''CREATE TABLE IF NOT EXISTS monthly_rules (guild_id INTEGER PRIMARY KEY, rule_ch INTEGER, target_ch INTEGER)''')
-            await db.commit()
+        self.conn = db = await aiosqlite.connect(self.path, cached_statements=256)
+        await db.executescript(
+            "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY; PRAGMA mmap_size=268435456;"
+            "PRAGMA cache_size=-64000; PRAGMA busy_timeout=10000; PRAGMA journal_size_limit=67108864;"
+        )
+        # usage_log は (user_id, date) を主キーにした WITHOUT ROWID 表。検索も UPSERT も B-tree 1本で済む
+        await db.execute('''CREATE TABLE IF NOT EXISTS usage_log (user_id TEXT NOT NULL, date TEXT NOT NULL, count INTEGER DEFAULT 0, PRIMARY KEY(user_id, date)) WITHOUT ROWID''')
+        usage_sql = (await (await db.execute("SELECT sql FROM sqlite_master WHERE name='usage_log'")).fetchone())[0]
+        if "WITHOUT ROWID" not in usage_sql:
+            # 旧スキーマ (rowid 表 + UNIQUE 索引) から作り直す
+            await db.executescript(
+                "BEGIN;"
+                "CREATE TABLE usage_log_new (user_id TEXT NOT NULL, date TEXT NOT NULL, count INTEGER DEFAULT 0, PRIMARY KEY(user_id, date)) WITHOUT ROWID;"
+                "INSERT OR IGNORE INTO usage_log_new SELECT user_id, date, count FROM usage_log;"
+                "DROP TABLE usage_log; ALTER TABLE usage_log_new RENAME TO usage_log;"
+                "COMMIT;"
+            )
+        await db.execute('''CREATE TABLE IF NOT EXISTS starboard_log (message_id INTEGER PRIMARY KEY)''')
+        await db.execute('''CREATE TABLE IF NOT EXISTS guild_settings (guild_id INTEGER PRIMARY KEY, welcome_ch INTEGER, log_ch INTEGER, starboard_ch INTEGER, auto_chat_ch INTEGER)''')
+        await db.execute('''CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, xp INTEGER DEFAULT 0, level INTEGER DEFAULT 1)''')
+        await db.execute('''CREATE TABLE IF NOT EXISTS level_rewards (guild_id INTEGER, level INTEGER, role_id INTEGER, PRIMARY KEY(guild_id, level))''')
+        await db.execute('''CREATE TABLE IF NOT EXISTS reaction_roles (message_id INTEGER, emoji TEXT, role_id INTEGER)''')
+        await db.execute('''CREATE TABLE IF NOT EXISTS ng_words (guild_id INTEGER, word TEXT)''')
+        await db.execute('''CREATE TABLE IF NOT EXISTS auto_replies (guild_id INTEGER, trigger TEXT, response TEXT)''')
+        await db.execute('''CREATE TABLE IF NOT EXISTS reminders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, channel_id INTEGER, message TEXT, end_time TEXT, end_ts INTEGER)''')
+        await db.execute('''CREATE TABLE IF NOT EXISTS monthly_rules (guild_id INTEGER PRIMARY KEY, rule_ch INTEGER, target_ch INTEGER)''')
+        # reminders: 旧スキーマ(end_time TEXT)に UNIX秒の end_ts を追加して移行
+        cols = [r[1] for r in await (await db.execute("PRAGMA table_info(reminders)")).fetchall()]
+        if "end_ts" not in cols:
+            await db.execute("ALTER TABLE reminders ADD COLUMN end_ts INTEGER")
+            await db.execute("UPDATE reminders SET end_ts=CAST(strftime('%s', end_time) AS INTEGER) WHERE end_ts IS NULL")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_reminders_end ON reminders(end_ts)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_autorep ON auto_replies(guild_id, trigger)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_ngw ON ng_words(guild_id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_rr ON reaction_roles(message_id, emoji)")
+        await db.commit()
+        for _ in range(Config.DB_READERS):
+            reader = await aiosqlite.connect(f"file:{self.path}?mode=ro", uri=True, cached_statements=256)
+            await reader.executescript("PRAGMA mmap_size=268435456; PRAGMA cache_size=-16000; PRAGMA busy_timeout=10000;")
+            self._readers.put_nowait(reader)
         logger.info(f"Database initialized: {self.path}")
 
-    # Helper methods
+    async def close(self):
+        while not self._readers.empty(): await self._readers.get_nowait().close()
+        if self.conn: await self.conn.close()
+
+    # Helper methods (書き込みは1本のコネクションをロックで直列化、読み取りは読み取り専用コネクションから)
     async def _execute(self, query, params=()):
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(query, params)
-            await db.commit()
+        async with self._lock:
+            await self.conn.execute(query, params)
+            await self.conn.commit()
     async def _fetchone(self, query, params=()):
-        async with aiosqlite.connect(self.path) as db:
-            cursor = await db.execute(query, params)
-            return await cursor.fetchone()
+        reader = await self._readers.get()
+        try:
+            async with reader.execute(query, params) as cursor:
+                return await cursor.fetchone()
+        finally:
+            self._readers.put_nowait(reader)
     async def _fetchall(self, query, params=()):
-        async with aiosqlite.connect(self.path) as db:
-            cursor = await db.execute(query, params)
-            return await cursor.fetchall()
+        reader = await self._readers.get()
+        try:
+            async with reader.execute(query, params) as cursor:
+                return await cursor.fetchall()
+        finally:
+            self._readers.put_nowait(reader)
 
-    # Config methods
+    # Config methods (ギルドの設定行をまるごとキャッシュ、書き込み時に更新)
     async def set_config(self, guild_id: int, col: str, val: int):
-        curr = await self._fetchone("SELECT guild_id FROM guild_settings WHERE guild_id=?", (guild_id,))
-        if curr: await self._execute(f"UPDATE guild_settings SET {col}=? WHERE guild_id=?", (val, guild_id))
-        else: await self._execute(f"INSERT INTO guild_settings (guild_id, {col}) VALUES (?, ?)", (guild_id, val))
+        # 既知の列の SQL だけを使う
+        sql = self.SET_CONFIG_SQL.get(col)
+        if sql is None: raise ValueError(f"unknown setting column: {col}")
+        await self._execute(sql, (guild_id, val))
+        if guild_id in self._config: self._config[guild_id][col] = val
     async def get_config(self, guild_id: int, col: str) -> Optional[int]:
-        res = await self._fetchone(f"SELECT {col} FROM guild_settings WHERE guild_id=?", (guild_id,))
-        return res[0] if res else None
-
-    # XP methods
+        settings = self._config.get(guild_id)
+        if settings is None:
+            res = await self._fetchone(self.GET_CONFIG_SQL, (guild_id,))
+            settings = self._config[guild_id] = dict(zip(self.SETTING_COLS, res or (None,) * len(self.SETTING_COLS)))
+        return settings[col]
+    async def preload_config(self):
+        for row in await self._fetchall(f"SELECT guild_id, {', '.join(self.SETTING_COLS)} FROM guild_settings"):
+            self._config[row[0]] = dict(zip(self.SETTING_COLS, row[1:]))
+
+    # XP methods (メモリ上で加算し、loop_flush_xp でまとめて書き込む)
     async def add_xp(self, user_id: int, amount: int = 10) -> bool:
-        row = await self._fetchone("SELECT xp, level FROM users WHERE user_id=?", (user_id,))
-        if row:
-            xp, level = row
-            xp += amount
-            is_up = False
-            if xp >= level * 100:
-                xp = 0
-                level += 1
-                is_up = True
-            await self._execute("UPDATE users SET xp=?, level=? WHERE user_id=?", (xp, level, user_id))
-            return is_up
-        else:
-            await self._execute("INSERT INTO users (user_id, xp, level) VALUES (?, ?, ?)", (user_id, amount, 1))
-            return False
+        entry = self._xp.get(user_id)
+        if entry is None:
+            row = await self._fetchone("SELECT level, xp FROM users WHERE user_id=?", (user_id,))
+            entry = self._xp.setdefault(user_id, list(row) if row else [1, 0])
+        self._xp.move_to_end(user_id)
+        entry[1] += amount
+        self._xp_dirty.add(user_id)
+        self._evict_xp()
+        if entry[1] >= entry[0] * 100:
+            entry[0] += 1
+            entry[1] = 0
+            return True
+        return False
+    def _evict_xp(self):
+        # 上限を超えた分を古い順に捨てる。未書き込み・書き込み中のものは残す (次に使う時は users から読み直す)
+        excess = len(self._xp) - Config.XP_CACHE_MAX
+        if excess <= 0: return
+        stale = (uid for uid in self._xp if uid not in self._xp_dirty and uid not in self._xp_flushing)
+        for uid in list(islice(stale, excess)): del self._xp[uid]
+    async def flush_xp(self):
+        if not self._xp_dirty: return
+        dirty, self._xp_dirty = self._xp_dirty, set()
+        rows = [(uid, self._xp[uid][1], self._xp[uid][0]) for uid in dirty]
+        self._xp_flushing |= dirty
+        try:
+            async with self._lock:
+                try:
+                    await self.conn.executemany("INSERT INTO users (user_id, xp, level) VALUES (?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET xp=excluded.xp, level=excluded.level", rows)
+                    await self.conn.commit()
+                except Exception:
+                    await self.conn.rollback()
+                    raise
+        except BaseException:
+            # 書けなかった分 (終了時のキャンセル含む) は次回の書き込み対象に戻す (値は self._xp に残っている)
+            self._xp_dirty |= dirty
+            raise
+        finally:
+            self._xp_flushing -= dirty
+        self._evict_xp()
     async def get_user_data(self, user_id: int):
+        if user_id in self._xp: return tuple(self._xp[user_id])
         res = await self._fetchone("SELECT level, xp FROM users WHERE user_id=?", (user_id,))
         return res if res else (1, 0)
     async def get_leaderboard(self, limit=30):
+        await self.flush_xp()
         return await self._fetchall("SELECT user_id, level, xp FROM users ORDER BY level DESC, xp DESC LIMIT ?", (limit,))
 
     # Usage limit
     async def check_daily_limit(self, user_id: str) -> bool:
-        today = datetime.now(JST).strftime('%Y-%m-%d')
-        row = await self._fetchone("SELECT count FROM usage_log WHERE user_id=? AND date=?", (user_id, today))
-        count = row[0] if row else 0
+        # 当日の回数はメモリで数え、loop_flush_xp でまとめて書き込む
+        today = today_jst()
+        if self._usage_day != today:
+            self._usage_pending += [(uid, self._usage_day, self._usage[uid]) for uid in self._usage_dirty]
+            self._usage_day, self._usage, self._usage_dirty = today, {}, set()
+        count = self._usage.get(user_id)
+        if count is None:
+            row = await self._fetchone("SELECT count FROM usage_log WHERE user_id=? AND date=?", (user_id, today))
+            # 読み込み中に日付が変わっていたら、その日の分として数え直す
+            if self._usage_day != today: return await self.check_daily_limit(user_id)
+            count = self._usage.setdefault(user_id, row[0] if row else 0)
         if count >= Config.DAILY_LIMIT: return False
-        if row: await self._execute("UPDATE usage_log SET count=count+1 WHERE user_id=? AND date=?", (user_id, today))
-        else: await self._execute("INSERT INTO usage_log (user_id, date, count) VALUES (?, ?, 1)", (user_id, today))
+        self._usage[user_id] = count + 1
+        self._usage_dirty.add(user_id)
         return True
+    async def flush_usage(self):
+        rows = self._usage_pending + [(uid, self._usage_day, self._usage[uid]) for uid in self._usage_dirty]
+        if not rows: return
+        self._usage_pending, self._usage_dirty = [], set()
+        try:
+            async with self._lock:
+                try:
+                    await self.conn.executemany("INSERT INTO usage_log (user_id, date, count) VALUES (?, ?, ?) ON CONFLICT(user_id, date) DO UPDATE SET count=excluded.count", rows)
+                    await self.conn.commit()
+                except Exception:
+                    await self.conn.rollback()
+                    raise
+        except BaseException:
+            self._usage_pending = rows + self._usage_pending
+            raise
+
+    # Reminders
+    async def add_reminder(self, user_id: int, channel_id: int, message: str, minutes: int) -> None:
+        end_ts = int(systime.time()) + minutes * 60
+        await self._execute("INSERT INTO reminders (user_id, channel_id, message, end_ts) VALUES (?, ?, ?, ?)", (user_id, channel_id, message, end_ts))
+    async def pop_due_reminders(self, now_ts: int):
+        async with self._lock:
+            async with self.conn.execute("DELETE FROM reminders WHERE end_ts <= ? RETURNING id, user_id, channel_id, message", (now_ts,)) as cursor:
+                rows = await cursor.fetchall()
+            await self.conn.commit()
+        return rows
+    async def next_reminder_ts(self) -> Optional[int]:
+        row = await self._fetchone("SELECT MIN(end_ts) FROM reminders")
+        return row[0] if row else None
+
+# システムプロンプトは (ユーザー名, 話題) で決まるので作った文字列を使い回す
+@lru_cache(maxsize=256)
+def chat_system_prompt(user_name: str, is_high: bool) -> str:
+    style = "【重要】今は「表現の自由」に関する話題です。スイッチが入ったように熱く語ってください。" if is_high else "親しみやすく、友達のような関西弁で振る舞ってください。"
+    return (
+        f"あなたは「表自派茜（ひょうじは あかね）」という元気な関西弁の女子高生AIです。\n"
+        f"一人称は「茜」。ユーザー名は「{user_name}」。\n{style}\n"
+        "ルール：1. 日本語・関西弁で話す。 2. 回答は1000文字以内。 3. 長くなりそうな場合は途中で切り上げ「まだ話し足りないけど、字数の制限があるからいったんここらで切り上げるわ！気になることがあったらまた声をかけてな！」と添える。"
+    )
 
 class AiManager:
     def __init__(self):
         self.model = Config.GPT_MODEL
-
-    async def call_gpt(self, system: str, user: str, model: str = Config.GPT_MODEL, max_tokens: int = 1000) -> str:
+        self._sem = asyncio.Semaphore(Config.AI_CONCURRENCY)
+        self._waiting = 0
+        self._no_stream: set[str] = set()  # ストリーミングを断られたモデル
+        self._calls: deque = deque()  # 直近60秒の呼び出し時刻
+        self._cache: OrderedDict[tuple, tuple[float, str]] = OrderedDict()  # (system, user, model) -> (時刻, 結果)
+
+    async def call_gpt(self, system: str, user: str, model: str = Config.GPT_MODEL, max_tokens: int = 1000,
+                       on_progress: Optional[Callable[[str], Awaitable[None]]] = None) -> str:
         if not openai_client: return "APIキーが設定されてへんで！"
-        
+        if self._sem.locked() and self._waiting >= Config.AI_MAX_WAITING:
+            return Config.BUSY_MSG
+        self._waiting += 1
+        try:
+            await self._sem.acquire()
+        finally:
+            self._waiting -= 1
+        try:
+            await self._wait_rate_slot()
+            return await self._call_gpt(system, user, model, max_tokens, on_progress)
+        finally:
+            self._sem.release()
+
+    async def _wait_rate_slot(self):
+        # スライディングウィンドウ: 直近60秒の呼び出しが上限なら、一番古いものが60秒前になるまで待つ
+        while True:
+            now = systime.monotonic()
+            while self._calls and now - self._calls[0] >= 60: self._calls.popleft()
+            if len(self._calls) < Config.AI_RPM: break
+            await asyncio.sleep(60 - (now - self._calls[0]))
+        self._calls.append(now)
+
+    async def _call_gpt(self, system: str, user: str, model: str, max_tokens: int, on_progress=None) -> str:
         is_reasoning = "gpt-5" in model or "o1" in model
         
         try:
@@ -156,10 +353,26 @@ class AiManager:
                 params["max_tokens"] = max_tokens
                 params["temperature"] = 0.7
             
-            loop = asyncio.get_running_loop()
-            resp = await loop.run_in_executor(None, lambda: openai_client.chat.completions.create(**params))
-            
-            content = resp.choices[0].message.content
+            content = None
+            if on_progress and model not in self._no_stream:
+                # 届いた分を一定間隔で on_progress に渡し、最後に全文を返す
+                try:
+                    parts, last = [], systime.monotonic()
+                    async for chunk in await openai_client.chat.completions.create(**params, stream=True):
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            parts.append(chunk.choices[0].delta.content)
+                            if systime.monotonic() - last >= Config.STREAM_EDIT_INTERVAL:
+                                last = systime.monotonic()
+                                await on_progress("".join(parts))
+                    content = "".join(parts)
+                except openai.BadRequestError as e:
+                    # 組織が未認証だと gpt-5 系はストリーミングできないので通常の呼び出しに戻す。それ以外の 400 はそのまま失敗扱い
+                    if getattr(e, "param", None) != "stream": raise
+                    logger.warning(f"AI stream unavailable, falling back: {e}")
+                    self._no_stream.add(model)
+            if content is None:
+                resp = await openai_client.chat.completions.create(**params)
+                content = resp.choices[0].message.content
             # ★重要: AIが空文字を返してきた場合
             if content is None or len(content.strip()) == 0:
                 return Config.EMPTY_MSG
@@ -171,18 +384,26 @@ class AiManager:
                 return Config.TIMEOUT_MSG
             return Config.ERROR_MSG
 
-    async def chat(self, user_name: str, content: str) -> str:
-        is_high = any(k in content for k in Config.REGULATION_KEYWORDS)
-        style = "【重要】今は「表現の自由」に関する話題です。スイッチが入ったように熱く語ってください。" if is_high else "親しみやすく、友達のような関西弁で振る舞ってください。"
-        system = (
-            f"あなたは「表自派茜（ひょうじは あかね）」という元気な関西弁の女子高生AIです。\n"
-            f"一人称は「茜」。ユーザー名は「{user_name}」。\n{style}\n"
-            "ルール：1. 日本語・関西弁で話す。 2. 回答は1000文字以内。 3. 長くなりそうな場合は途中で切り上げ「まだ話し足りないけど、字数の制限があるからいったんここらで切り上げるわ！気になることがあったらまた声をかけてな！」と添える。"
-        )
-        return await self.call_gpt(system, content, model=Config.GPT_MODEL, max_tokens=Config.NORMAL_CHAT_MAX_TOKENS)
-
-    async def translate(self, text: str, target_lang: str) -> str:
-        return await self.call_gpt(f"Translate to {target_lang}. Output ONLY the translated text.", text, model=Config.FAST_MODEL)
+    async def chat(self, user_name: str, content: str, on_progress=None) -> str:
+        system = chat_system_prompt(user_name, REGULATION_RE.search(content) is not None)
+        return await self.call_gpt(system, content, model=Config.GPT_MODEL, max_tokens=Config.NORMAL_CHAT_MAX_TOKENS, on_progress=on_progress)
+
+    async def call_gpt_cached(self, system: str, user: str, model: str, max_tokens: int = 1000, on_progress=None) -> str:
+        # 翻訳・辞書は同じ入力なら同じ答えでよいので、しばらく使い回す (失敗時の定型文は覚えない)
+        key = (system, user, model)
+        hit = self._cache.get(key)
+        if hit and systime.monotonic() - hit[0] < Config.AI_CACHE_TTL:
+            self._cache.move_to_end(key)
+            return hit[1]
+        res = await self.call_gpt(system, user, model=model, max_tokens=max_tokens, on_progress=on_progress)
+        if res not in (Config.BUSY_MSG, Config.ERROR_MSG, Config.TIMEOUT_MSG, Config.EMPTY_MSG):
+            self._cache[key] = (systime.monotonic(), res)
+            self._cache.move_to_end(key)
+            if len(self._cache) > Config.AI_CACHE_MAX: self._cache.popitem(last=False)
+        return res
+
+    async def translate(self, text: str, target_lang: str, on_progress=None) -> str:
+        return await self.call_gpt_cached(f"Translate to {target_lang}. Output ONLY the translated text.", text, model=Config.FAST_MODEL, on_progress=on_progress)
 
     async def define_word(self, word: str, wiki_mode: bool) -> str:
         if wiki_mode:
@@ -190,7 +411,7 @@ class AiManager:
         else:
             sys = f"あなたは高性能な辞書です。「{word}」という言葉の意味を、400文字以内で分かりやすく解説してください。"
         sys += "\n【重要】必ず文章を完結させてください。途中で切れてはいけません。"
-        return await self.call_gpt(sys, word, model=Config.FAST_MODEL, max_tokens=1000)
+        return await self.call_gpt_cached(sys, word, model=Config.FAST_MODEL, max_tokens=1000)
 
     async def summarize(self, text_list: List[str]) -> str:
         return await self.call_gpt("以下の発言ログを400文字以内で要約して。一人称「茜」、関西弁で。", "\n".join(text_list), model=Config.GPT_MODEL, max_tokens=800)
@@ -199,18 +420,14 @@ class AiManager:
 class EventView(discord.ui.View):
     def __init__(self): super().__init__(timeout=None)
     async def _update(self, i, status):
+        # 受け取った Embed のフィールドだけを差し替えて返す
         embed = i.message.embeds[0]
-        new_fields = []
-        target = f"【{status}】"
-        for f in embed.fields:
-            vals = [l for l in f.value.split('\n') if i.user.mention not in l and "なし" not in l]
-            if f.name == target: vals.append(f"• {i.user.mention}")
-            new_fields.append((f.name, '\n'.join(vals) or "なし"))
-        new_embed = discord.Embed(title=embed.title, description=embed.description, color=embed.color)
-        new_embed.set_footer(text=embed.footer.text)
-        new_embed.timestamp = embed.timestamp
-        for n, v in new_fields: new_embed.add_field(name=n, value=v)
-        await i.response.edit_message(embed=new_embed)
+        mention = i.user.mention
+        for idx, f in enumerate(embed.fields):
+            vals = [l for l in f.value.split('\n') if mention not in l and "なし" not in l]
+            if f.name.strip("【】") == status: vals.append(f"• {mention}")
+            embed.set_field_at(idx, name=f.name, value='\n'.join(vals) or "なし", inline=f.inline)
+        await i.response.edit_message(embed=embed)
     @discord.ui.button(label="参加", style=discord.ButtonStyle.success, custom_id="ev_join")
     async def join(self, i, b): await self._update(i, "参加")
     @discord.ui.button(label="不参加", style=discord.ButtonStyle.danger, custom_id="ev_leave")
@@ -281,6 +498,7 @@ class AdminCommands(app_commands.Group):
             msg = await i.channel.fetch_message(int(message_id))
             await msg.add_reaction(emoji)
             await self.bot.db._execute("INSERT INTO reaction_roles (message_id, emoji, role_id) VALUES (?, ?, ?)", (msg.id, emoji, role.id))
+            self.bot._rr[(msg.id, emoji)] = role.id
             await i.response.send_message("設定完了", ephemeral=True)
         except:
             await i.response.send_message("エラー: IDを確認してな", ephemeral=True)
@@ -289,16 +507,18 @@ class AdminCommands(app_commands.Group):
     @app_commands.describe(level="到達レベル", role="付与するロール")
     async def level_reward(self, i: discord.Interaction, level: int, role: discord.Role):
         await self.bot.db._execute("INSERT OR REPLACE INTO level_rewards (guild_id, level, role_id) VALUES (?, ?, ?)", (i.guild.id, level, role.id))
+        self.bot._rewards.pop(i.guild.id, None)
         await i.response.send_message(f"Lv.{level} で {role.name} をあげる設定にしたで！", ephemeral=True)
 
     @app_commands.command(name="level_reward_remove", description="レベル報酬削除")
     async def level_reward_remove(self, i: discord.Interaction, level: int):
         await self.bot.db._execute("DELETE FROM level_rewards WHERE guild_id=? AND level=?", (i.guild.id, level))
+        self.bot._rewards.pop(i.guild.id, None)
         await i.response.send_message(f"Lv.{level} の報酬設定を削除したで。", ephemeral=True)
 
     @app_commands.command(name="level_reward_list", description="レベル報酬一覧")
     async def level_reward_list(self, i: discord.Interaction):
-        rows = await self.bot.db._fetchall("SELECT level, role_id FROM level_rewards WHERE guild_id=? ORDER BY level ASC", (i.guild.id,))
+        rows = await self.bot.get_level_rewards(i.guild.id)
         if not rows:
             await i.response.send_message("設定なし。", ephemeral=True)
             return
@@ -308,11 +528,13 @@ class AdminCommands(app_commands.Group):
     @app_commands.command(name="filter_add", description="NGワード追加")
     async def filter_add(self, i: discord.Interaction, word: str):
         await self.bot.db._execute("INSERT INTO ng_words (guild_id, word) VALUES (?, ?)", (i.guild.id, word))
+        self.bot._ng_matcher.pop(i.guild.id, None)
         await i.response.send_message(f"NG追加: {word}", ephemeral=True)
 
     @app_commands.command(name="response_add", description="自動応答追加")
     async def response_add(self, i: discord.Interaction, trigger: str, response: str):
         await self.bot.db._execute("INSERT INTO auto_replies (guild_id, trigger, response) VALUES (?, ?, ?)", (i.guild.id, trigger, response))
+        self.bot._auto_replies.pop(i.guild.id, None)
         await i.response.send_message(f"応答追加: {trigger} -> {response}", ephemeral=True)
 
     @app_commands.command(name="kick", description="Kick")
@@ -329,9 +551,10 @@ class AdminCommands(app_commands.Group):
     @app_commands.describe(amount="削除数", user="対象ユーザー", hours="対象期間(時間)")
     async def purge(self, i: discord.Interaction, amount: int, user: Optional[discord.Member]=None, hours: Optional[int]=None):
         await i.response.defer(ephemeral=True)
-        cutoff = datetime.now(pytz.utc) - timedelta(hours=hours) if hours else None
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=hours) if hours else None
+        user_id = user.id if user else None
         def check(m):
-            if user and m.author != user: return False
+            if user_id and m.author.id != user_id: return False
             if cutoff and m.created_at < cutoff: return False
             return True
         deleted = await i.channel.purge(limit=min(amount, 300), check=check)
@@ -342,14 +565,32 @@ class AdminCommands(app_commands.Group):
 # ==============================================================================
 class AkaneBot(commands.Bot):
     def __init__(self):
-        intents = discord.Intents.all()
-        super().__init__(command_prefix='!', intents=intents, help_command=None)
+        # presence / typing は使わないので受け取らない。起動時のメンバー一括取得もしない
+        intents = discord.Intents.default()
+        intents.members = True
+        intents.message_content = True
+        intents.typing = False
+        super().__init__(command_prefix='!', intents=intents, help_command=None, chunk_guilds_at_startup=False)
         self.db = DatabaseManager(Config.DB_NAME)
         self.ai = AiManager()
-        self.spam_check = defaultdict(lambda: deque(maxlen=5))
+        self.spam_check: OrderedDict[int, deque] = OrderedDict()
+        self._ng_matcher: dict[int, Optional[re.Pattern]] = {}
+        self._rewards: dict[int, list[tuple[int, int]]] = {}
+        self._rr: dict[tuple[int, str], int] = {}
+        self._auto_replies: dict[int, dict[str, str]] = {}
+        self._heart_counts: dict[int, int] = {}
+        self._starboarded: set[int] = set()
+        self._ai_inflight: set[int] = set()
+        self._audit_buf: dict[int, list[discord.Embed]] = {}
+        self._send_sem = asyncio.Semaphore(Config.SEND_CONCURRENCY)
+        self._reminder_wake = asyncio.Event()
 
     async def setup_hook(self):
         await self.db.init()
+        await self.db.preload_config()
+        rows = await self.db._fetchall("SELECT message_id, emoji, role_id FROM reaction_roles ORDER BY rowid")
+        self._rr = {(m, e): r for m, e, r in rows}
+        self._starboarded = {r[0] for r in await self.db._fetchall("SELECT message_id FROM starboard_log")}
         self.add_view(EventView())
         self.add_view(TicketView())
         self.add_view(TicketCloseView())
@@ -358,108 +599,230 @@ class AkaneBot(commands.Bot):
         
         self.loop_reminders.start()
         self.loop_monthly.start()
+        self.loop_flush_xp.start()
+        self.loop_flush_audit.start()
+
+    async def close(self):
+        # 先にループを止めてから残りを書き出す。途中で切れた書き込み分はバッファに戻るので下でまとめて書く
+        loops = (self.loop_reminders, self.loop_monthly, self.loop_flush_xp, self.loop_flush_audit)
+        for loop in loops: loop.cancel()
+        await asyncio.gather(*(t for loop in loops if (t := loop.get_task())), return_exceptions=True)
+        try: await self.db.flush_xp()
+        except Exception as e: logger.error(f"XP flush failed: {e}")
+        try: await self.db.flush_usage()
+        except Exception as e: logger.error(f"Usage flush failed: {e}")
+        await self.flush_audit()
+        await self.db.close()
+        await super().close()
+
+    # --- Caches ---
+    async def get_ng_matcher(self, guild_id: int) -> Optional[re.Pattern]:
+        # NGワードはギルドごとに1本の正規表現にまとめてキャッシュ (casefold済みの本文に当てる、filter_addで破棄)
+        if guild_id not in self._ng_matcher:
+            rows = await self.db._fetchall("SELECT word FROM ng_words WHERE guild_id=?", (guild_id,))
+            words = sorted({w.casefold() for (w,) in rows if w}, key=len, reverse=True)
+            self._ng_matcher[guild_id] = re.compile("|".join(map(re.escape, words))) if words else None
+        return self._ng_matcher[guild_id]
+
+    async def get_level_rewards(self, guild_id: int) -> list[tuple[int, int]]:
+        # (level, role_id) をレベル昇順でキャッシュ (level_reward系コマンドで破棄)
+        if guild_id not in self._rewards:
+            rows = await self.db._fetchall("SELECT level, role_id FROM level_rewards WHERE guild_id=? ORDER BY level ASC", (guild_id,))
+            self._rewards[guild_id] = [tuple(r) for r in rows]
+        return self._rewards[guild_id]
+
+    async def get_auto_replies(self, guild_id: int) -> dict[str, str]:
+        # 正規化した trigger -> response (同じtriggerは先に登録された方を優先、response_addで破棄)
+        if guild_id not in self._auto_replies:
+            rows = await self.db._fetchall("SELECT trigger, response FROM auto_replies WHERE guild_id=? ORDER BY rowid", (guild_id,))
+            replies = {}
+            for trigger, response in rows: replies.setdefault(trigger.strip().casefold(), response)
+            self._auto_replies[guild_id] = replies
+        return self._auto_replies[guild_id]
+
+    async def get_message(self, channel_id: int, message_id: int) -> discord.Message:
+        # ゲートウェイのメッセージキャッシュを優先し、無い時だけREST取得
+        msg = discord.utils.get(self.cached_messages, id=message_id)
+        if msg: return msg
+        return await self.get_channel(channel_id).fetch_message(message_id)
 
     async def on_ready(self):
         logger.info(f'Logged in as {self.user}')
         await self.tree.sync()
 
     # --- Tasks ---
-    @tasks.loop(seconds=60)
+    async def send_limited(self, ch, content):
+        async with self._send_sem:
+            return await ch.send(content)
+
+    @tasks.loop()
     async def loop_reminders(self):
-        now_str = datetime.now(JST).isoformat()
-        rows = await self.db._fetchall("SELECT id, user_id, channel_id, message FROM reminders WHERE end_time <= ?", (now_str,))
-        if rows:
-            ids = [r[0] for r in rows]
-            await self.db._execute(f"DELETE FROM reminders WHERE id IN ({','.join(['?']*len(ids))})", ids)
-            for r in rows:
-                ch = self.get_channel(r[2])
-                if ch: await ch.send(f"⏰ <@{r[1]}> リマインダー: {r[3]}")
+        # 次の期限まで眠り、/remind で追加されたら起きて期限を見直す
+        self._reminder_wake.clear()
+        # 一時的な失敗 (database is locked 等) でループを止めない。その時は最長間隔で見直す
+        timeout = Config.REMINDER_MAX_SLEEP
+        try:
+            now = int(systime.time())
+            rows = await self.db.pop_due_reminders(now)
+            sends = [self.send_limited(ch, f"⏰ <@{r[1]}> リマインダー: {r[3]}") for r in rows if (ch := self.get_channel(r[2]))]
+            if sends: await asyncio.gather(*sends, return_exceptions=True)
+            next_ts = await self.db.next_reminder_ts()
+            if next_ts is not None: timeout = min(max(next_ts - now, 1), Config.REMINDER_MAX_SLEEP)
+        except Exception as e: logger.error(f"Reminder check failed: {e}")
+        try: await asyncio.wait_for(self._reminder_wake.wait(), timeout)
+        except asyncio.TimeoutError: pass
+
+    @loop_reminders.before_loop
+    async def before_reminders(self):
+        await self.wait_until_ready()
+
+    @tasks.loop(seconds=15)
+    async def loop_flush_xp(self):
+        # 一時的な失敗 (database is locked 等) でループを止めない。未書き込み分は次の周回で書く
+        try: await self.db.flush_xp()
+        except Exception as e: logger.error(f"XP flush failed: {e}")
+        try: await self.db.flush_usage()
+        except Exception as e: logger.error(f"Usage flush failed: {e}")
+
+    # 削除ログは2秒ごとにまとめて送る (1通に Embed 10個・合計6000文字まで)
+    async def flush_audit(self):
+        buf, self._audit_buf = self._audit_buf, {}
+        for ch_id, embeds in buf.items():
+            ch = self.get_channel(ch_id)
+            if not ch: continue
+            batches, size = [[]], 0
+            for e in embeds:
+                if batches[-1] and (len(batches[-1]) == 10 or size + len(e) > 6000):
+                    batches.append([])
+                    size = 0
+                batches[-1].append(e)
+                size += len(e)
+            for batch in batches:
+                try: await ch.send(embeds=batch)
+                except: pass
+
+    @tasks.loop(seconds=2)
+    async def loop_flush_audit(self):
+        if self._audit_buf: await self.flush_audit()
 
     @tasks.loop(time=time(hour=7, minute=0, tzinfo=JST))
     async def loop_monthly(self):
         if datetime.now(JST).day != 1: return
-        rows = await self.db._fetchall("SELECT rule_ch, target_ch FROM monthly_rules")
-        for rule_id, target_id in rows:
-            ch = self.get_channel(target_id)
+        rows = await self.db._fetchall("SELECT guild_id, rule_ch, target_ch FROM monthly_rules")
+        sends = []
+        for guild_id, rule_id, target_id in rows:
+            guild = self.get_guild(guild_id)
+            ch = guild.get_channel(target_id) if guild else None
             if ch:
                 msg = (
                     "表現の自由界隈のみなさん、おはよーさん！☀️ 新しい一ヶ月が始まったで〜！🚀\n"
                     f"📌 **ルールブック:** <#{rule_id}>\n目を通しておいてな！"
                 )
-                try: await ch.send(msg)
-                except: pass
+                sends.append(self.send_limited(ch, msg))
+        if sends: await asyncio.gather(*sends, return_exceptions=True)
 
     # --- Events ---
     async def on_message(self, message):
         if message.author.bot or not message.guild: return
         
         # Spam Check
-        now = datetime.now().timestamp()
-        self.spam_check[message.author.id].append(now)
-        if len(self.spam_check[message.author.id]) == 5:
-            if self.spam_check[message.author.id][-1] - self.spam_check[message.author.id][0] < 5:
-                if not message.author.guild_permissions.administrator:
-                    await message.channel.send(f"{message.author.mention} 連投はやめてな！", delete_after=5)
-                    return
+        now = systime.monotonic()
+        hist = self.spam_check.get(message.author.id)
+        if hist is None:
+            hist = self.spam_check[message.author.id] = deque(maxlen=5)
+            if len(self.spam_check) > Config.SPAM_TRACK_MAX: self.spam_check.popitem(last=False)
+        else:
+            self.spam_check.move_to_end(message.author.id)
+        hist.append(now)
+        if len(hist) == 5 and hist[-1] - hist[0] < 5:
+            if not message.author.guild_permissions.administrator:
+                await message.channel.send(f"{message.author.mention} 連投はやめてな！", delete_after=5)
+                return
+
+        # 未キャッシュのギルドは NG / 自動応答 / 常駐ch を並行して読み込む
+        if message.guild.id not in self._auto_replies:
+            await asyncio.gather(self.get_ng_matcher(message.guild.id), self.get_auto_replies(message.guild.id), self.db.get_config(message.guild.id, "auto_chat_ch"))
+
+        folded = message.content.strip().casefold()
 
         # NG Words
-        ngs = await self.db._fetchall("SELECT word FROM ng_words WHERE guild_id=?", (message.guild.id,))
-        for (word,) in ngs:
-            if word in message.content:
-                await message.delete()
-                await message.channel.send(f"{message.author.mention} NGワードやで！", delete_after=3)
-                return
+        ng = await self.get_ng_matcher(message.guild.id)
+        if ng and ng.search(folded):
+            await message.delete()
+            await message.channel.send(f"{message.author.mention} NGワードやで！", delete_after=3)
+            return
 
         # Auto Reply
-        res = await self.db._fetchone("SELECT response FROM auto_replies WHERE guild_id=? AND trigger=?", (message.guild.id, message.content))
+        res = (await self.get_auto_replies(message.guild.id)).get(folded)
         if res:
-            await message.channel.send(res[0])
+            await message.channel.send(res)
             return
 
         # AI Chat
-        auto_ch = await self.db.get_config(message.guild.id, "auto_chat_ch")
-        is_target = (self.user in message.mentions) or (message.channel.id == auto_ch)
+        is_target = (self.user in message.mentions) or (message.channel.id == await self.db.get_config(message.guild.id, "auto_chat_ch"))
         
         if is_target:
-            if await self.db.check_daily_limit(str(message.author.id)):
-                clean_text = re.sub(r'<@!?\d+>', '', message.content).strip()
-                if clean_text:
-                    async with message.channel.typing():
-                        reply = await self.ai.chat(message.author.display_name, clean_text)
-                        
-                        if not reply or reply.strip() == "":
-                            reply = Config.EMPTY_MSG
-
-                        if len(reply) > 1900:
-                            f = discord.File(io.BytesIO(reply.encode()), filename="reply.txt")
-                            await message.reply("長くなったからファイルにしたで！", file=f)
-                        else:
-                            await message.reply(reply)
+            # 返答待ちの間に同じユーザーが連投しても AI は1本ずつ (判定直後、await の前に登録する)
+            if message.author.id in self._ai_inflight:
+                await message.reply("ちょっと待ってな、今考えとるとこや！", delete_after=5)
             else:
-                await message.reply("今日の会話回数は終わりや。また明日な！")
+                self._ai_inflight.add(message.author.id)
+                try:
+                    if await self.db.check_daily_limit(str(message.author.id)):
+                        clean_text = MENTION_RE.sub('', message.content).strip()
+                        if clean_text:
+                            # 返答は届いた所から同じメッセージを書き換えて見せる
+                            sent = None
+                            async def progress(partial: str):
+                                nonlocal sent
+                                try:
+                                    if sent: await sent.edit(content=partial[:1900] + " …")
+                                    else: sent = await message.reply(partial[:1900] + " …")
+                                except discord.HTTPException: pass
+                            async with message.channel.typing():
+                                reply = await self.ai.chat(message.author.display_name, clean_text, on_progress=progress)
+                                
+                                if not reply or reply.strip() == "":
+                                    reply = Config.EMPTY_MSG
+
+                                if len(reply) > 1900:
+                                    if sent: await sent.delete()
+                                    f = discord.File(io.BytesIO(reply.encode()), filename="reply.txt")
+                                    await message.reply("長くなったからファイルにしたで！", file=f)
+                                elif sent:
+                                    await sent.edit(content=reply)
+                                else:
+                                    await message.reply(reply)
+                    else:
+                        await message.reply("今日の会話回数は終わりや。また明日な！")
+                finally:
+                    self._ai_inflight.discard(message.author.id)
 
         # XP
         if await self.db.add_xp(message.author.id, 10):
             lv, _ = await self.db.get_user_data(message.author.id)
-            rewards = await self.db._fetchall("SELECT role_id FROM level_rewards WHERE guild_id=? AND level<=?", (message.guild.id, lv))
-            for r in rewards:
-                role = message.guild.get_role(r[0])
-                if role: await message.author.add_roles(role)
+            rewards = await self.get_level_rewards(message.guild.id)
+            roles = [message.guild.get_role(role_id) for _, role_id in rewards[:bisect.bisect_right(rewards, lv, key=lambda r: r[0])]]
+            roles = [r for r in roles if r and r not in message.author.roles]
+            if roles: await message.author.add_roles(*roles, reason="レベル報酬")
             await message.channel.send(f"🎉 {message.author.mention} レベルアップ！ (Lv.{lv})")
 
     async def on_raw_reaction_add(self, payload):
         if payload.member.bot: return
+        emoji = str(payload.emoji)
         # Role
-        row = await self.db._fetchone("SELECT role_id FROM reaction_roles WHERE message_id=? AND emoji=?", (payload.message_id, str(payload.emoji)))
-        if row:
-            role = payload.member.guild.get_role(row[0])
+        role_id = self._rr.get((payload.message_id, emoji))
+        if role_id:
+            role = payload.member.guild.get_role(role_id)
             if role: await payload.member.add_roles(role)
+        # カスタム絵文字は国旗でもハートでもない
+        if payload.emoji.is_custom_emoji(): return
+        lang = Config.FLAG_MAP.get(emoji)
+        if lang is None and emoji != "❤️": return
         # Translation (Embed対策済み)
-        if str(payload.emoji) in Config.FLAG_MAP:
-            ch = self.get_channel(payload.channel_id)
-            msg = await ch.fetch_message(payload.message_id)
+        if lang:
+            msg = await self.get_message(payload.channel_id, payload.message_id)
             if msg.content:
-                lang = Config.FLAG_MAP[str(payload.emoji)]
                 trans = await self.ai.translate(msg.content, lang)
                 
                 if not trans or trans.strip() == "": trans = Config.ERROR_MSG
@@ -474,53 +837,77 @@ class AkaneBot(commands.Bot):
                     try: await payload.member.send(embed=embed)
                     except: pass
 
-        # Starboard
-        if str(payload.emoji) == "❤️":
-            ch = self.get_channel(payload.channel_id)
-            msg = await ch.fetch_message(payload.message_id)
-            reaction = discord.utils.get(msg.reactions, emoji="❤️")
-            if reaction and reaction.count >= 10:
-                posted = await self.db._fetchone("SELECT message_id FROM starboard_log WHERE message_id=?", (msg.id,))
-                if not posted:
-                    sb_ch_id = await self.db.get_config(payload.guild_id, "starboard_ch")
-                    if sb_ch_id:
-                        sb_ch = self.get_channel(sb_ch_id)
-                        embed = discord.Embed(description=msg.content, color=discord.Color.red(), timestamp=msg.created_at)
-                        embed.set_author(name=msg.author.display_name, icon_url=msg.author.display_avatar.url)
-                        embed.add_field(name="Original", value=f"[Jump]({msg.jump_url})")
-                        if msg.attachments: embed.set_image(url=msg.attachments[0].url)
-                        await sb_ch.send("いいねがたくさん。殿堂入りやね！（茜）", embed=embed)
-                        await self.db._execute("INSERT INTO starboard_log (message_id) VALUES (?)", (msg.id,))
+        # Starboard (❤️の数はメモリで数えて、10個に届いた時だけメッセージ本体を使う)
+        if emoji == "❤️":
+            if payload.message_id in self._starboarded: return
+            msg = discord.utils.get(self.cached_messages, id=payload.message_id)
+            if msg:
+                reaction = discord.utils.get(msg.reactions, emoji="❤️")
+                count = reaction.count if reaction else 0
+            elif payload.message_id in self._heart_counts:
+                count = self._heart_counts[payload.message_id] + 1
+            else:
+                msg = await self.get_message(payload.channel_id, payload.message_id)
+                reaction = discord.utils.get(msg.reactions, emoji="❤️")
+                count = reaction.count if reaction else 0
+            self._heart_counts[payload.message_id] = count
+            if len(self._heart_counts) > Config.HEART_TRACK_MAX: del self._heart_counts[next(iter(self._heart_counts))]
+            if count < 10: return
+            if not msg: msg = await self.get_message(payload.channel_id, payload.message_id)
+            sb_ch_id = await self.db.get_config(payload.guild_id, "starboard_ch")
+            sb_ch = payload.member.guild.get_channel(sb_ch_id) if sb_ch_id else None
+            if sb_ch:
+                # 送信中に来た❤️で二重投稿しないよう先に押さえ、送信に失敗した時だけ外して次の❤️で再挑戦させる
+                self._starboarded.add(msg.id)
+                embed = discord.Embed(description=msg.content, color=discord.Color.red(), timestamp=msg.created_at)
+                embed.set_author(name=msg.author.display_name, icon_url=msg.author.display_avatar.url)
+                embed.add_field(name="Original", value=f"[Jump]({msg.jump_url})")
+                if msg.attachments: embed.set_image(url=msg.attachments[0].url)
+                try: await sb_ch.send("いいねがたくさん。殿堂入りやね！（茜）", embed=embed)
+                except Exception:
+                    self._starboarded.discard(msg.id)
+                    raise
+                self._heart_counts.pop(msg.id, None)
+                # 投稿済みなので記録に失敗しても印は残す (このプロセスの間はメモリの印で再投稿を防ぐ)
+                try: await self.db._execute("INSERT INTO starboard_log (message_id) VALUES (?)", (msg.id,))
+                except Exception as e: logger.error(f"Starboard log failed: {e}")
 
     async def on_raw_reaction_remove(self, payload):
-        row = await self.db._fetchone("SELECT role_id FROM reaction_roles WHERE message_id=? AND emoji=?", (payload.message_id, str(payload.emoji)))
-        if row:
+        emoji = str(payload.emoji)
+        if emoji == "❤️" and payload.message_id in self._heart_counts:
+            self._heart_counts[payload.message_id] -= 1
+        role_id = self._rr.get((payload.message_id, emoji))
+        if role_id:
             guild = self.get_guild(payload.guild_id)
+            role = guild.get_role(role_id)
+            if not role: return
             member = guild.get_member(payload.user_id)
-            role = guild.get_role(row[0])
-            if member and role: await member.remove_roles(role)
+            if not member:
+                try: member = await guild.fetch_member(payload.user_id)
+                except discord.NotFound: return
+            await member.remove_roles(role)
 
     async def on_message_delete(self, message):
-        if message.author.bot: return
+        if message.author.bot or not message.guild: return
         log_id = await self.db.get_config(message.guild.id, "log_ch")
-        if log_id:
-            ch = message.guild.get_channel(log_id)
-            if ch:
-                embed = discord.Embed(title="🗑️ 削除ログ", description=message.content, color=discord.Color.red())
-                embed.set_author(name=message.author.display_name, icon_url=message.author.display_avatar.url)
-                embed.add_field(name="場所", value=message.channel.mention)
-                await ch.send(embed=embed)
+        if not log_id: return
+        ch = message.guild.get_channel(log_id)
+        if not ch: return
+        embed = discord.Embed(title="🗑️ 削除ログ", description=message.content, color=discord.Color.red())
+        embed.set_author(name=message.author.display_name, icon_url=message.author.display_avatar.url)
+        embed.add_field(name="場所", value=message.channel.mention)
+        self._audit_buf.setdefault(ch.id, []).append(embed)
 
     async def on_voice_state_update(self, member, before, after):
         if before.channel == after.channel: return
         log_id = await self.db.get_config(member.guild.id, "log_ch")
-        if log_id:
-            ch = member.guild.get_channel(log_id)
-            desc = ""
-            if not before.channel: desc = f"📥 参加: {after.channel.name}"
-            elif not after.channel: desc = f"📤 退出: {before.channel.name}"
-            else: desc = f"➡️ 移動: {before.channel.name} -> {after.channel.name}"
-            await ch.send(embed=discord.Embed(description=f"{member.mention} {desc}", color=discord.Color.green()))
+        if not log_id: return
+        ch = member.guild.get_channel(log_id)
+        if not ch: return
+        if not before.channel: desc = f"📥 参加: {after.channel.name}"
+        elif not after.channel: desc = f"📤 退出: {before.channel.name}"
+        else: desc = f"➡️ 移動: {before.channel.name} -> {after.channel.name}"
+        await ch.send(embed=discord.Embed(description=f"{member.mention} {desc}", color=discord.Color.green()))
 
     async def on_member_join(self, member):
         wc_id = await self.db.get_config(member.guild.id, "welcome_ch")
@@ -528,6 +915,10 @@ class AkaneBot(commands.Bot):
             ch = member.guild.get_channel(wc_id)
             if ch: await ch.send(f"{member.mention} 表現の自由界隈サーバーへようこそ。このサーバーのマスコットキャラクターの表自派茜（ひょうじは あかね）やで！ ゆっくりしていってな！")
 
+    async def on_guild_remove(self, guild):
+        # 抜けたギルドの設定キャッシュは二度と使わないので捨てる
+        for cache in (self._ng_matcher, self._rewards, self._auto_replies, self.db._config): cache.pop(guild.id, None)
+
 bot = AkaneBot()
 
 # ==============================================================================
@@ -539,15 +930,27 @@ bot = AkaneBot()
 @app_commands.describe(language="翻訳先の言語", text="原文")
 async def translate(i: discord.Interaction, language: str, text: str):
     await i.response.defer()
-    res = await bot.ai.translate(text, language)
+    # 訳せた所から順に見せる (途中経過は同じメッセージを書き換え)
+    msg = None
+    async def progress(partial: str):
+        nonlocal msg
+        embed = discord.Embed(title=f"翻訳 ({language})", description=partial[:4000] + " …", color=discord.Color.blue())
+        try:
+            if msg: await msg.edit(embed=embed)
+            else: msg = await i.followup.send(embed=embed, wait=True)
+        except discord.HTTPException: pass
+    res = await bot.ai.translate(text, language, on_progress=progress)
     
     if not res or res.strip() == "": res = Config.ERROR_MSG
     
     if len(res) > 4000:
+        if msg: await msg.delete()
         f = discord.File(io.BytesIO(res.encode()), filename="trans.txt")
         await i.followup.send("長すぎるからファイルにするな！", file=f)
     else:
-        await i.followup.send(embed=discord.Embed(title=f"翻訳 ({language})", description=res, color=discord.Color.blue()))
+        embed = discord.Embed(title=f"翻訳 ({language})", description=res, color=discord.Color.blue())
+        if msg: await msg.edit(embed=embed)
+        else: await i.followup.send(embed=embed)
 
 @bot.tree.command(name="define", description="AI辞書 (400文字解説)")
 @app_commands.describe(word="言葉", wiki_mode="Wikipedia優先モード")
@@ -619,14 +1022,15 @@ async def poll(i: discord.Interaction, question: str, option1: str, option2: str
 async def search(i: discord.Interaction, keyword: str, target_channel: Optional[discord.TextChannel]=None, member: Optional[discord.Member]=None, days: Optional[int]=None):
     await i.response.defer(ephemeral=True)
     ch = target_channel if target_channel else i.channel
-    after = datetime.now(pytz.utc) - timedelta(days=days) if days else None
+    after = datetime.now(timezone.utc) - timedelta(days=days) if days else None
     found = []
     try:
+        member_id = member.id if member else None
         async for m in ch.history(limit=1000, after=after):
-            if member and m.author != member: continue
-            if keyword in m.content:
-                found.append(m)
-                if len(found) >= 100: break
+            if member_id and m.author.id != member_id: continue
+            if keyword not in m.content: continue
+            found.append(m)
+            if len(found) >= 100: break
     except: pass
     if not found: await i.followup.send("なし", ephemeral=True); return
     if len(found) > 20:
@@ -645,16 +1049,24 @@ async def level(i: discord.Interaction):
 async def leaderboard(i: discord.Interaction):
     await i.response.defer(ephemeral=True)
     rows = await bot.db.get_leaderboard(30)
-    text = ""
+    # メンバーは全件キャッシュしていないので、足りない分だけまとめて問い合わせる
+    missing = [int(r[0]) for r in rows if not i.guild.get_member(int(r[0]))]
+    fetched = {}
+    if missing:
+        try: fetched = {m.id: m for m in await i.guild.query_members(user_ids=missing, cache=False)}
+        except asyncio.TimeoutError: pass
+    lines = []
     for idx, (uid, lv, xp) in enumerate(rows, 1):
-        u = i.guild.get_member(int(uid))
+        u = i.guild.get_member(int(uid)) or fetched.get(int(uid))
         name = u.display_name if u else "Unknown"
-        text += f"{idx}. {name} (Lv.{lv})\n"
-    await i.followup.send(embed=discord.Embed(title="🏆 ランキング", description=text or "データなし", color=discord.Color.gold()), ephemeral=True)
+        lines.append(f"{idx}. {name} (Lv.{lv})")
+    await i.followup.send(embed=discord.Embed(title="🏆 ランキング", description="\n".join(lines) or "データなし", color=discord.Color.gold()), ephemeral=True)
 
 @bot.tree.command(name="remind", description="リマインダー")
 async def remind(i: discord.Interaction, minutes: int, message: str):
     await bot.db.add_reminder(i.user.id, i.channel.id, message, minutes)
+    # ループが DB を見ている最中に追加されても取りこぼさないよう、毎回起こして期限を見直させる
+    bot._reminder_wake.set()
     await i.response.send_message(f"{minutes}分後に通知するで。", ephemeral=True)
 
 if __name__ == '__main__':